@@ -3,17 +3,20 @@ import os
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0" # 新增：强制仅使用第一张显卡
 os.environ["WANDB_DISABLED"] = "true"
-import jieba
 import dataclasses as dc
 import functools
+import json
+import re
 from collections.abc import Callable, Mapping, Sequence
+from multiprocessing import get_context
 from pathlib import Path
 from typing import Annotated, Any, Union
 import numpy as np
 import ruamel.yaml as yaml
 import torch
 import typer
-from datasets import Dataset, Split
+import multiprocess
+from datasets import Array3D, Dataset, Features, Split, Value
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 from peft import PeftConfig, get_peft_config, get_peft_model
 from rouge_chinese import Rouge
@@ -33,11 +36,26 @@ from datasets import load_dataset, DatasetDict, NamedSplit
 from typing import Optional
 from PIL import Image
 
+try:
+    import jieba_fast as jieba  # Cython drop-in replacement for jieba
+except ImportError:
+    import jieba
+
 app = typer.Typer(pretty_exceptions_show_locals=False)
 
+_CHECKPOINT_RE = re.compile(r"^checkpoint-(\d+)$")
+
 
+@dc.dataclass
 class DataCollatorForSeq2Seq(_DataCollatorForSeq2Seq):
+    # (height, width) of the stored images, used for the placeholder of image-less samples
+    image_size: tuple[int, int] = (672, 672)
+
     def __call__(self, features, return_tensors=None):
+        # Samples without an image carry pixel_values=None; the placeholder is only materialized here
+        pixel_values = (
+            [feature.pop("pixel_values") for feature in features] if "pixel_values" in features[0].keys() else None
+        )
         output_ids = [feature["output_ids"] for feature in features] if "output_ids" in features[0].keys() else None
         if output_ids is not None:
             max_output_length = max(len(out) for out in output_ids)
@@ -47,16 +65,39 @@ class DataCollatorForSeq2Seq(_DataCollatorForSeq2Seq):
                     // self.pad_to_multiple_of
                     * self.pad_to_multiple_of
                 )
-            for feature in features:
-                remainder = [self.tokenizer.pad_token_id] * (max_output_length - len(feature["output_ids"]))
-                if isinstance(feature["output_ids"], list):
-                    feature["output_ids"] = feature["output_ids"] + remainder
-                else:
-                    feature["output_ids"] = np.concatenate([feature["output_ids"], remainder]).astype(np.int64)
-        return super().__call__(features, return_tensors)
+            padded_output_ids = np.full(
+                (len(features), max_output_length), self.tokenizer.pad_token_id, dtype=np.int64
+            )
+            for i, (feature, out) in enumerate(zip(features, output_ids)):
+                padded_output_ids[i, : len(out)] = out
+                feature["output_ids"] = padded_output_ids[i]
+        batch = super().__call__(features, return_tensors)
+        if pixel_values is not None:
+            # Images stay uint8 until they reach the GPU, see Seq2SeqTrainer._prepare_inputs
+            empty_pixel_values = torch.zeros([3, *self.image_size], dtype=torch.uint8)
+            batch["pixel_values"] = torch.stack(
+                [empty_pixel_values if pv is None else torch.as_tensor(pv, dtype=torch.uint8) for pv in pixel_values]
+            )
+            batch["has_image"] = torch.tensor([pv is not None for pv in pixel_values])
+        return batch
 
 
 class Seq2SeqTrainer(_Seq2SeqTrainer):
+    def __init__(self, *args, image_mean: Sequence[float], image_std: Sequence[float], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._image_mean = torch.tensor(image_mean, device=self.args.device).view(-1, 1, 1)
+        self._image_std = torch.tensor(image_std, device=self.args.device).view(-1, 1, 1)
+
+    def _prepare_inputs(self, inputs):
+        inputs = super()._prepare_inputs(inputs)
+        if "has_image" in inputs:
+            # Rescale and normalize the uint8 images on the device; image-less samples get all-zero pixels
+            has_image = inputs.pop("has_image")
+            pixel_values = inputs["pixel_values"].float().div_(255).sub_(self._image_mean).div_(self._image_std)
+            pixel_values[~has_image] = 0
+            inputs["pixel_values"] = pixel_values.to(torch.bfloat16)
+        return inputs
+
     def prediction_step(
         self,
         model: nn.Module,
@@ -85,9 +126,6 @@ class Seq2SeqTrainer(_Seq2SeqTrainer):
 
             if self.args.predict_with_generate:
                 labels = output_ids
-            
-            del inputs, output_ids
-            torch.cuda.empty_cache()
 
         return loss, generated_tokens, labels
 
@@ -145,6 +183,12 @@ class FinetuningConfig(object):
             gen_config = training_args.get("generation_config")
             if not isinstance(gen_config, GenerationConfig):
                 training_args["generation_config"] = GenerationConfig(**gen_config)
+            # Overlap batch loading/collation with GPU compute unless the config sets these explicitly
+            training_args.setdefault("dataloader_num_workers", 4)
+            training_args.setdefault("dataloader_pin_memory", True)
+            if training_args["dataloader_num_workers"] > 0:
+                training_args.setdefault("dataloader_prefetch_factor", 2)
+                training_args.setdefault("dataloader_persistent_workers", True)
             kwargs["training_args"] = Seq2SeqTrainingArguments(**training_args)
 
         data_config = kwargs.get("data_config")
@@ -186,7 +230,9 @@ def _load_datasets(
 
 class DataManager(object):
     def __init__(self, data_dir: str, data_config: DataConfig):
-        self._num_proc = data_config.num_proc
+        # Image decoding and tokenization are CPU-bound, so fan out over half the cores by default.
+        # Each worker runs its own single-threaded fast tokenizer.
+        self._num_proc = data_config.num_proc or max(1, (os.cpu_count() or 2) // 2)
 
         self._dataset_dct = _load_datasets(
             data_dir,
@@ -204,6 +250,7 @@ class DataManager(object):
         process_fn: Callable[[dict[str, Any]], dict[str, Any]],
         batched: bool = True,
         remove_orig_columns: bool = True,
+        features: Optional[Features] = None,
     ) -> Optional[Dataset]:
         orig_dataset = self._get_dataset(split)
         if orig_dataset is None:
@@ -217,6 +264,7 @@ class DataManager(object):
             batched=batched,
             remove_columns=remove_columns,
             num_proc=self._num_proc,
+            features=features,
             # This is default params of  orig_dataset.map, and you can change it smaller
             # https://github.com/THUDM/GLM-4/issues/277
             writer_batch_size=1000,
@@ -224,13 +272,83 @@ class DataManager(object):
         )
 
 
+def _processed_features(image_size: tuple[int, int], target_column: str) -> Features:
+    # Explicit column types, so a writer batch in which no sample has an image doesn't infer a null pixel_values
+    int_sequence = [Value("int64")]
+    return Features(
+        {
+            "input_ids": int_sequence,
+            "attention_mask": int_sequence,
+            "position_ids": int_sequence,
+            target_column: int_sequence,
+            "pixel_values": Array3D(shape=(3, *image_size), dtype="uint8"),
+        }
+    )
+
+
+def _load_image(path: str, image_size: tuple[int, int], resample: int) -> np.ndarray:
+    image = Image.open(path)
+    # Let libjpeg decode directly at a reduced scale that still covers twice the target size (no-op for non-JPEG)
+    image.draft("RGB", (image_size[1] * 2, image_size[0] * 2))
+    # Only the resize happens while building the dataset, so the Arrow cache holds uint8 pixels;
+    # rescaling and normalization run on the GPU in Seq2SeqTrainer._prepare_inputs
+    image = image.convert("RGB").resize((image_size[1], image_size[0]), resample=resample)
+    return np.asarray(image).transpose(2, 0, 1)
+
+
+# Token ids of already rendered chat messages, keyed by the serialized message. System prompts and
+# repeated turns recur across conversations, so hits skip both the chat template and the tokenizer.
+_MESSAGE_CACHE_SIZE = 65536
+_message_cache: dict[str, list[int]] = {}
+
+
+def _encode_messages(tokenizer: PreTrainedTokenizer, messages: Sequence[dict]) -> list[list[int]]:
+    keys = [json.dumps(message, ensure_ascii=False, sort_keys=True) for message in messages]
+    input_ids = [_message_cache.get(key) for key in keys]
+    missing = {key: message for key, message, ids in zip(keys, messages, input_ids) if ids is None}
+    if not missing:
+        return input_ids
+
+    rendered_messages = [
+        tokenizer.apply_chat_template([message], add_generation_prompt=False, tokenize=False)
+        for message in missing.values()
+    ]
+    encoded = dict(zip(missing, tokenizer(rendered_messages, add_special_tokens=False)["input_ids"]))
+    for key, ids in encoded.items():
+        if len(_message_cache) >= _MESSAGE_CACHE_SIZE:
+            _message_cache.pop(next(iter(_message_cache)))
+        _message_cache[key] = ids
+    return [encoded[key] if ids is None else ids for key, ids in zip(keys, input_ids)]
+
+
+# Tokenizer for the datasets.map functions; forked workers inherit it, otherwise main passes tokenizer=
+_TOK: Optional[PreTrainedTokenizer] = None
+
+
+def _init_process_globals(tokenizer: PreTrainedTokenizer) -> None:
+    global _TOK
+    _TOK = tokenizer
+
+
+def _process_tokenizer(tokenizer: Optional[PreTrainedTokenizer]) -> PreTrainedTokenizer:
+    if tokenizer is None:
+        tokenizer = _TOK
+    if tokenizer is None:
+        raise RuntimeError(
+            "The map function has no tokenizer: call _init_process_globals() or pass tokenizer="
+        )
+    return tokenizer
+
+
 def process_batch(
     batch: Mapping[str, Sequence],
-    tokenizer: PreTrainedTokenizer,
-    processor,
     max_input_length: int,
     max_output_length: int,
+    image_size: tuple[int, int],
+    resample: int,
+    tokenizer: Optional[PreTrainedTokenizer] = None,
 ) -> dict[str, list]:
+    tokenizer = _process_tokenizer(tokenizer)
     batched_conv = batch["messages"]
     batched_input_ids = []
     batched_attention_mask = []
@@ -240,80 +358,54 @@ def process_batch(
 
     max_length = max_input_length + max_output_length
 
+    # Encode every message of the batch at once; cache misses are tokenized in a single call
+    encoded_messages = _encode_messages(tokenizer, [message for conv in batched_conv for message in conv])
+    message_idx = 0
+
     for conv in batched_conv:
-        input_ids = []
-        attention_mask = []
-        position_ids = []
-        loss_masks = []
-        pixel_values = []
+        pixel_values = None
 
         if conv[0]["content"][0].get("image"):
-            image = Image.open(conv[0]["content"][0]["image"])
-            pixel_values.append(torch.tensor(processor(image).pixel_values))
-
-        for message in conv:
-            loss_mask_val = False if message["role"] in ("system", "user") else True
-            new_input_ids_all = tokenizer.apply_chat_template(
-                [message],
-                add_generation_prompt=False,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            )
-            new_input_ids = new_input_ids_all["input_ids"][0].tolist()
-            new_attention_mask = new_input_ids_all["attention_mask"][0].tolist()
-            new_position_ids = list(range(len(position_ids), len(position_ids) + len(new_input_ids)))
-
-            new_loss_masks = [loss_mask_val] * len(new_input_ids)
-            input_ids += new_input_ids
-            attention_mask += new_attention_mask
-            position_ids += new_position_ids
-            loss_masks += new_loss_masks
-
-        input_ids.append(59253)  # EOS
-        attention_mask.append(1)
-        position_ids.append(len(position_ids))
-        loss_masks.append(True)
+            pixel_values = _load_image(conv[0]["content"][0]["image"], image_size, resample)
+
+        conv_input_ids = encoded_messages[message_idx : message_idx + len(conv)]
+        message_idx += len(conv)
+
+        # Walk back from the last message until max_length tokens (plus EOS) are covered. Earlier messages
+        # would be cut by the left truncation anyway, so only their lengths are needed for the positions.
+        first_kept = len(conv)
+        num_tokens = 1
+        while first_kept > 0 and num_tokens < max_length:
+            first_kept -= 1
+            num_tokens += len(conv_input_ids[first_kept])
+        start_position = sum(len(ids) for ids in conv_input_ids[:first_kept])
+
+        kept_input_ids = conv_input_ids[first_kept:]
+        input_ids = np.concatenate(
+            [np.asarray(ids, dtype=np.int64) for ids in kept_input_ids] + [np.array([59253], dtype=np.int64)]  # EOS
+        )
+        attention_mask = np.ones_like(input_ids)
+        position_ids = np.arange(start_position, start_position + len(input_ids), dtype=np.int64)
+        loss_masks = np.repeat(
+            [message["role"] not in ("system", "user") for message in conv[first_kept:]] + [True],
+            [len(ids) for ids in kept_input_ids] + [1],
+        )
 
         padding_length = max(0, max_length - len(input_ids))
 
-        # Left padding with batch
-        input_ids = [tokenizer.pad_token_id] * padding_length + input_ids[-max_length:]
-        attention_mask = [0] * padding_length + attention_mask[-max_length:]
-        position_ids = [0] * padding_length + position_ids[-max_length:]
-        loss_masks = [False] * padding_length + loss_masks[-max_length:]
+        # Left padding with batch; the results are exactly max_length long
+        input_ids = np.pad(input_ids[-max_length:], (padding_length, 0), constant_values=tokenizer.pad_token_id)
+        attention_mask = np.pad(attention_mask[-max_length:], (padding_length, 0))
+        position_ids = np.pad(position_ids[-max_length:], (padding_length, 0))
+        loss_masks = np.pad(loss_masks[-max_length:], (padding_length, 0))
 
-        labels = []
-        for input_id, mask in zip(input_ids, loss_masks):
-            if mask:
-                labels.append(input_id)
-            else:
-                labels.append(-100)
-
-        batched_input_ids.append(input_ids[:max_length])
-        batched_attention_mask.append(attention_mask[:max_length])
-        batched_position_ids.append(position_ids[:max_length])
-        batched_labels.append(labels[:max_length])
-        if len(pixel_values) > 0:
-            batched_images.append(pixel_values[0][0])
-        else:
-            batched_images.append(torch.zeros([1, 1, 3, 672, 672]))
-
-    del (
-        batched_conv,
-        conv,
-        input_ids,
-        attention_mask,
-        position_ids,
-        loss_masks,
-        message,
-        new_input_ids,
-        new_loss_masks,
-        labels,
-        input_id,
-        mask,
-    )
-    torch.cuda.empty_cache()
+        labels = np.where(loss_masks, input_ids, -100)
+
+        batched_input_ids.append(input_ids)
+        batched_attention_mask.append(attention_mask)
+        batched_position_ids.append(position_ids)
+        batched_labels.append(labels)
+        batched_images.append(pixel_values)
 
     return {
         "input_ids": batched_input_ids,
@@ -326,11 +418,13 @@ def process_batch(
 
 def process_batch_eval(
     batch: Mapping[str, Sequence],
-    tokenizer: PreTrainedTokenizer,
-    processor,
     max_input_length: int,
     max_output_length: int,
+    image_size: tuple[int, int],
+    resample: int,
+    tokenizer: Optional[PreTrainedTokenizer] = None,
 ) -> dict[str, list]:
+    tokenizer = _process_tokenizer(tokenizer)
     batched_conv = batch["messages"]
     batched_input_ids = []
     batched_attention_mask = []
@@ -340,7 +434,9 @@ def process_batch_eval(
 
     for conv in batched_conv:
         if conv[0]["content"][0].get("image"):
-            image = Image.open(conv[0]["content"][0]["image"])
+            pixel_values = _load_image(conv[0]["content"][0]["image"], image_size, resample)
+        else:
+            pixel_values = None
 
         new_input_ids_all = tokenizer.apply_chat_template(
             conv,
@@ -348,47 +444,33 @@ def process_batch_eval(
             tokenize=True,
             padding=True,
             return_dict=True,
-            return_tensors="pt",
         )
 
-        input_ids = new_input_ids_all["input_ids"][0].tolist()
-        attention_mask = new_input_ids_all["attention_mask"][0].tolist()
-        position_ids = list(range(len(input_ids)))
-
-        dialogue_parts = [0]
-        for idx, token_id in enumerate(input_ids):
-            if token_id == 59254:
-                dialogue_parts.append(idx + 1)
+        input_ids = np.asarray(new_input_ids_all["input_ids"], dtype=np.int64)
+        attention_mask = np.asarray(new_input_ids_all["attention_mask"], dtype=np.int64)
 
-        if not dialogue_parts or dialogue_parts[-1] != len(input_ids):
-            dialogue_parts.append(len(input_ids))
+        # Each dialogue segment ends right after a 59254 token; the last one ends with the conversation
+        dialogue_parts = np.concatenate([[0], np.flatnonzero(input_ids == 59254) + 1])
+        if dialogue_parts[-1] != len(input_ids):
+            dialogue_parts = np.append(dialogue_parts, len(input_ids))
 
         # Split the conversation into multiple dialogue segments
-        for end_idx in range(1, len(dialogue_parts)):
-            input_segment = input_ids[: dialogue_parts[end_idx]]
-            attention_segment = attention_mask[: dialogue_parts[end_idx]]
-            position_segment = position_ids[: dialogue_parts[end_idx]]
-            output_segment = input_ids[dialogue_parts[end_idx - 1] : dialogue_parts[end_idx]]
-            output_segment.append(59253)  # Add EOS token
+        for start, end in zip(dialogue_parts[:-1], dialogue_parts[1:]):
+            output_segment = np.append(input_ids[start:end], 59253)  # Add EOS token
 
             # Left Padding
-            padding_length = max(0, max_input_length - len(input_segment))
-            input_segment = [tokenizer.pad_token_id] * padding_length + input_segment[:max_input_length]
-            attention_segment = [0] * padding_length + attention_segment[:max_input_length]
-            position_segment = [0] * padding_length + position_segment[:max_input_length]
-            output_segment = [tokenizer.pad_token_id] * padding_length + output_segment[:max_output_length]
+            padding_length = max(0, max_input_length - end)
+            input_segment = np.pad(
+                input_ids[:end][:max_input_length], (padding_length, 0), constant_values=tokenizer.pad_token_id
+            )
+            attention_segment = np.pad(attention_mask[:end][:max_input_length], (padding_length, 0))
+            position_segment = np.pad(np.arange(min(end, max_input_length)), (padding_length, 0))
 
             batched_input_ids.append(input_segment[:max_input_length])
             batched_attention_mask.append(attention_segment[:max_input_length])
             batched_position_ids.append(position_segment[:max_input_length])
             batched_output_ids.append(output_segment[:max_output_length])
-            if conv[0]["content"][0].get("image"): 
-                batched_images.append(torch.tensor(processor(image).pixel_values)[0])
-            else:
-                batched_images.append(torch.zeros([1, 1, 3, 672, 672]))
-
-    del batched_conv, input_ids, attention_mask, position_ids, new_input_ids_all, output_segment
-    torch.cuda.empty_cache()
+            batched_images.append(pixel_values)
 
     return {
         "input_ids": batched_input_ids,
@@ -414,24 +496,48 @@ def load_tokenizer_and_model(
     return tokenizer, model, processor
 
 
-#    def compute_metrics(eval_preds: EvalPrediction, tokenizer):
-#        batched_pred_ids, batched_label_ids = eval_preds
-#        batched_pred_ids[batched_pred_ids == -100] = tokenizer.pad_token_id
-#        batched_label_ids[batched_label_ids == -100] = tokenizer.pad_token_id
-#        metrics_dct = {"rouge-1": [], "rouge-2": [], "rouge-l": [], "bleu-4": []}
-#        for pred_ids, label_ids in zip(batched_pred_ids, batched_label_ids):
-#            pred_txt = tokenizer.decode(pred_ids, skip_special_tokens=True).strip()
-#            label_txt = tokenizer.decode(label_ids, skip_special_tokens=True).strip()
-#            pred_tokens = list(jieba.cut(pred_txt))
-#            label_tokens = list(jieba.cut(label_txt))
-#            rouge = Rouge()
-#            scores = rouge.get_scores(" ".join(pred_tokens), " ".join(label_tokens))
-#            for k, v in scores[0].items():
-#                metrics_dct[k].append(round(v["f"] * 100, 4))
-#            metrics_dct["bleu-4"].append(
-#                sentence_bleu([label_tokens], pred_tokens, smoothing_function=SmoothingFunction().method3)
-#            )
-#        return {k: np.mean(v) for k, v in metrics_dct.items()}
+# Starting worker processes only pays off for large eval sets; below this many texts jieba runs in-process
+_PARALLEL_CUT_MIN_TEXTS = 4000
+_PARALLEL_CUT_MAX_PROCS = 4
+
+
+def _cut(text: str) -> list[str]:
+    return list(jieba.cut(text))
+
+
+def compute_metrics(eval_preds: EvalPrediction, tokenizer):
+    batched_pred_ids, batched_label_ids = eval_preds
+    batched_pred_ids[batched_pred_ids == -100] = tokenizer.pad_token_id
+    batched_label_ids[batched_label_ids == -100] = tokenizer.pad_token_id
+    pred_txts = [txt.strip() for txt in tokenizer.batch_decode(batched_pred_ids, skip_special_tokens=True)]
+    label_txts = [txt.strip() for txt in tokenizer.batch_decode(batched_label_ids, skip_special_tokens=True)]
+
+    # Word segmentation is pure Python, so spread large eval sets over a few processes. They are spawned, not
+    # forked, so they don't inherit the CUDA context, the model or live dataloader/tokenizer threads.
+    texts = pred_txts + label_txts
+    if len(texts) >= _PARALLEL_CUT_MIN_TEXTS:
+        num_procs = min(_PARALLEL_CUT_MAX_PROCS, os.cpu_count() or 1)
+        with get_context("spawn").Pool(num_procs) as pool:
+            all_tokens = pool.map(_cut, texts, chunksize=256)
+    else:
+        all_tokens = [_cut(text) for text in texts]
+    batched_pred_tokens, batched_label_tokens = all_tokens[: len(pred_txts)], all_tokens[len(pred_txts) :]
+
+    rouge = Rouge()
+    metrics_dct = {"rouge-1": [], "rouge-2": [], "rouge-l": [], "bleu-4": []}
+    for pred_tokens, label_tokens in zip(batched_pred_tokens, batched_label_tokens):
+        # Rouge rejects empty strings; an empty prediction or reference scores 0
+        if not "".join(pred_tokens).strip() or not "".join(label_tokens).strip():
+            for k in metrics_dct:
+                metrics_dct[k].append(0.0)
+            continue
+        scores = rouge.get_scores(" ".join(pred_tokens), " ".join(label_tokens))
+        for k, v in scores[0].items():
+            metrics_dct[k].append(round(v["f"] * 100, 4))
+        metrics_dct["bleu-4"].append(
+            sentence_bleu([label_tokens], pred_tokens, smoothing_function=SmoothingFunction().method3)
+        )
+    return {k: np.mean(v) for k, v in metrics_dct.items()}
 
 
 @app.command()
@@ -457,46 +563,35 @@ def main(
     ft_config.training_args.local_rank = -1  # 禁用分布式训练
     ft_config.training_args._n_gpu = 1       # 显式设置GPU数量为1
 
+    # Make accelerate's host-to-device copies from pinned memory asynchronous. They still run on the default
+    # stream when the batch is requested, so they do not overlap with the previous batch's compute.
+    ft_config.training_args.accelerator_config.non_blocking = True
+
     if ft_config.freezeV:
         for param in model.base_model.model.model.vision.parameters():
             param.requires_grad = False
     data_manager = DataManager(data_dir, ft_config.data_config)
-
-    train_dataset = data_manager.get_dataset(
-        Split.TRAIN,
-        functools.partial(
-            process_batch,
-            tokenizer=tokenizer,
-            processor=processor,
-            max_input_length=ft_config.max_input_length,
-            max_output_length=ft_config.max_output_length,
-        ),
-        batched=True,
-    )
-
-    val_dataset = data_manager.get_dataset(
-        Split.VALIDATION,
-        functools.partial(
-            process_batch_eval,
-            tokenizer=tokenizer,
-            processor=processor,
-            max_input_length=ft_config.max_input_length,
-            max_output_length=ft_config.max_output_length,
-        ),
-        batched=True,
-    )
-
-    test_dataset = data_manager.get_dataset(
-        Split.TEST,
-        functools.partial(
-            process_batch_eval,
-            tokenizer=tokenizer,
-            processor=processor,
-            max_input_length=ft_config.max_input_length,
-            max_output_length=ft_config.max_output_length,
-        ),
-        batched=True,
+    _init_process_globals(tokenizer)
+
+    image_size = (processor.size["height"], processor.size["width"])
+    process_kwargs = dict(
+        max_input_length=ft_config.max_input_length,
+        max_output_length=ft_config.max_output_length,
+        image_size=image_size,
+        resample=processor.resample,
     )
+    # datasets starts its workers through multiprocess, not the stdlib multiprocessing
+    start_method = multiprocess.get_start_method(allow_none=True) or multiprocess.get_all_start_methods()[0]
+    if start_method != "fork":
+        process_kwargs["tokenizer"] = tokenizer
+    train_process_fn = functools.partial(process_batch, **process_kwargs)
+    eval_process_fn = functools.partial(process_batch_eval, **process_kwargs)
+
+    train_features = _processed_features(image_size, "labels")
+    eval_features = _processed_features(image_size, "output_ids")
+    train_dataset = data_manager.get_dataset(Split.TRAIN, train_process_fn, batched=True, features=train_features)
+    val_dataset = data_manager.get_dataset(Split.VALIDATION, eval_process_fn, batched=True, features=eval_features)
+    test_dataset = data_manager.get_dataset(Split.TEST, eval_process_fn, batched=True, features=eval_features)
 
     model.gradient_checkpointing_enable()
     model.enable_input_require_grads()
@@ -508,23 +603,28 @@ def main(
             tokenizer=tokenizer,
             padding="longest",
             return_tensors="pt",
+            image_size=image_size,
         ),
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
-        # compute_metrics=functools.partial(compute_metrics, tokenizer=tokenizer),
+        compute_metrics=functools.partial(compute_metrics, tokenizer=tokenizer),
+        image_mean=processor.image_mean,
+        image_std=processor.image_std,
     )
 
     if auto_resume_from_checkpoint.upper() == "" or auto_resume_from_checkpoint is None:
         trainer.train()
     else:
         output_dir = ft_config.training_args.output_dir
-        dirlist = os.listdir(output_dir)
-        checkpoint_sn = 0
-        for checkpoint_str in dirlist:
-            if checkpoint_str.find("checkpoint") > 0 and checkpoint_str.find("tmp") == -1:
-                checkpoint = int(checkpoint_str.replace("checkpoint-", ""))
-                if checkpoint > checkpoint_sn:
-                    checkpoint_sn = checkpoint
+        with os.scandir(output_dir) as entries:
+            checkpoint_sn = max(
+                (
+                    int(m.group(1))
+                    for entry in entries
+                    if (m := _CHECKPOINT_RE.match(entry.name)) and entry.is_dir()
+                ),
+                default=0,
+            )
         if auto_resume_from_checkpoint.upper() == "YES":
             if checkpoint_sn > 0:
                 model.gradient_checkpointing_enable()
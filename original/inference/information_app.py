@@ -1,10 +1,17 @@
 from flask import Flask, render_template
 
 app = Flask(__name__)
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+
+# more_information.html is static, so render it once at import time instead of per request
+with app.app_context():
+    MORE_INFORMATION_HTML = render_template('more_information.html')
 
 @app.route('/')
 def index():
-    return render_template('more_information.html')
+    return MORE_INFORMATION_HTML
 
+# Production: serve with a prefork WSGI server instead of the Werkzeug dev server, e.g.
+#   gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:8000 information_app:app
 if __name__ == '__main__':
-    app.run(debug=True, port=8000, host='0.0.0.0')
\ No newline at end of file
+    app.run(port=8000, host='0.0.0.0')